@@ -21,6 +21,7 @@ MIGRATIONS = [
     "add_environment_to_crypto_klines.py",
     "add_prompt_template_fields.py",
     "add_ai_prompt_chat.py",
+    "add_active_paper_account_index.py",
 ]
 
 def check_migration_table():
@@ -0,0 +1,36 @@
+#!/usr/bin/env python3
+"""
+Migration: Add partial index for active paper-mode AI accounts
+
+The market stream refresh checks whether any active, auto-trading AI account
+still runs in paper mode (hyperliquid_environment IS NULL). This partial index
+lets that existence check resolve from a small index instead of scanning accounts.
+"""
+
+import sys
+import os
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
+from sqlalchemy import create_engine, text
+from database.connection import DATABASE_URL
+
+def migrate():
+    """Create idx_accounts_active_paper_ai if it does not exist"""
+    engine = create_engine(DATABASE_URL)
+
+    with engine.connect() as conn:
+        conn.execute(text("""
+            CREATE INDEX IF NOT EXISTS idx_accounts_active_paper_ai
+            ON accounts(is_active, auto_trading_enabled, account_type)
+            WHERE hyperliquid_environment IS NULL
+        """))
+
+        conn.commit()
+        print("✅ Partial index idx_accounts_active_paper_ai created")
+
+def upgrade():
+    """Entry point for migration manager"""
+    migrate()
+
+if __name__ == "__main__":
+    migrate()
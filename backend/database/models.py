@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, DECIMAL, TIMESTAMP, ForeignKey, UniqueConstraint, Float, Date, DateTime, Text
+from sqlalchemy import Column, Integer, String, DECIMAL, TIMESTAMP, ForeignKey, UniqueConstraint, Index, Float, Date, DateTime, Text
 from sqlalchemy.orm import relationship
 from sqlalchemy.sql import func
 import datetime
@@ -67,6 +67,17 @@ class Account(Base):
         TIMESTAMP, server_default=func.current_timestamp(), onupdate=func.current_timestamp()
     )
 
+    # Partial index for the "any active paper-mode AI account?" check run on every stream refresh
+    __table_args__ = (
+        Index(
+            "idx_accounts_active_paper_ai",
+            "is_active",
+            "auto_trading_enabled",
+            "account_type",
+            postgresql_where=hyperliquid_environment.is_(None),
+        ),
+    )
+
     # Relationships
     user = relationship("User", back_populates="accounts")
     positions = relationship("Position", back_populates="account")
@@ -590,6 +601,9 @@ class KlineAIAnalysisLog(Base):
     # Metadata
     created_at = Column(TIMESTAMP, server_default=func.current_timestamp(), index=True)
 
+    # Fetch server-generated created_at via INSERT ... RETURNING during flush
+    __mapper_args__ = {"eager_defaults": True}
+
     # Relationships
     user = relationship("User")
     account = relationship("Account")
@@ -2095,7 +2095,7 @@ def _build_klines_and_indicators_context(
                 count = requirements['klines']['count']
                 # Take last N candles for display
                 display_klines = kline_data[-count:] if len(kline_data) >= count else kline_data
-                formatted_klines = _format_klines_summary(display_klines)
+                formatted_klines = _format_klines_summary(display_klines, symbol, period)
 
                 # Variable name: {BTC_klines_15m}
                 var_name = f"{symbol}_klines_{period}"
@@ -323,18 +323,25 @@ def get_conversation_messages(
     if not conversation:
         return None
 
-    messages = db.query(AiPromptMessage).filter(
+    # Select plain columns and fetch in chunks so long histories never hold a full
+    # set of ORM instances alongside the result dicts
+    rows = db.query(
+        AiPromptMessage.id,
+        AiPromptMessage.role,
+        AiPromptMessage.content,
+        AiPromptMessage.prompt_result,
+        AiPromptMessage.created_at,
+    ).filter(
         AiPromptMessage.conversation_id == conversation_id
-    ).order_by(AiPromptMessage.created_at).all()
-
-    result = []
-    for msg in messages:
-        result.append({
-            "id": msg.id,
-            "role": msg.role,
-            "content": msg.content,
-            "promptResult": msg.prompt_result,
-            "createdAt": msg.created_at.isoformat() if msg.created_at else None,
-        })
-
-    return result
+    ).order_by(AiPromptMessage.created_at).yield_per(200)
+
+    return [
+        {
+            "id": msg_id,
+            "role": role,
+            "content": content,
+            "promptResult": prompt_result,
+            "createdAt": created_at.isoformat() if created_at else None,
+        }
+        for msg_id, role, content, prompt_result, created_at in rows
+    ]
@@ -9,19 +9,24 @@ Handles:
 """
 from __future__ import annotations
 
-import json
+import hashlib
 import logging
-from typing import Dict, List, Optional
+import sys
+from typing import Dict, List, Optional, Tuple
 
 import requests
+from sqlalchemy import func
+from sqlalchemy.dialects.postgresql import insert as pg_insert
 from sqlalchemy.orm import Session
 
 from database.connection import SessionLocal
 from database.models import SystemConfig, Account
+from utils import fast_json
 
 logger = logging.getLogger(__name__)
 
 AVAILABLE_SYMBOLS_KEY = "hyperliquid_available_symbols"
+AVAILABLE_SYMBOLS_HASH_KEY = "hyperliquid_available_symbols_hash"
 SELECTED_SYMBOLS_KEY = "hyperliquid_selected_symbols"
 MAX_WATCHLIST_SYMBOLS = 10
 SYMBOL_REFRESH_TASK_ID = "hyperliquid_symbol_refresh"
@@ -38,64 +43,77 @@ META_ENDPOINTS = {
     "mainnet": "https://api.hyperliquid.xyz/info",
 }
 
+# (connect, read) seconds: fail fast on DNS/connect issues, allow time for the payload
+META_REQUEST_TIMEOUT = (3, 10)
+
+# Shared HTTP session so periodic refreshes reuse pooled keep-alive connections
+_SESSION = requests.Session()
+
+# Memoized market stream symbol list; "version" is bumped whenever the catalog or
+# watchlist changes, and the cached list is reused while calc_version matches it.
+_STREAM_CACHE: Dict[str, object] = {"version": 0, "symbols": None, "calc_version": -1}
+
+
+def invalidate_market_stream_symbols() -> None:
+    """Force the next build_market_stream_symbols() call to recompute from the DB."""
+    _STREAM_CACHE["version"] = int(_STREAM_CACHE["version"]) + 1
+
 
 def _load_config_value(db: Session, key: str) -> Optional[str]:
     config = db.query(SystemConfig).filter(SystemConfig.key == key).first()
     return config.value if config else None
 
 
-def _save_config_value(db: Session, key: str, value: str) -> None:
-    config = db.query(SystemConfig).filter(SystemConfig.key == key).first()
-    if not config:
-        config = SystemConfig(key=key, value=value)
-        db.add(config)
-    else:
-        config.value = value
-    db.commit()
+def _save_config_value(db: Session, key: str, value: str, commit: bool = True) -> None:
+    # Single-statement upsert: avoids the SELECT round-trip and the read-modify-write race
+    stmt = pg_insert(SystemConfig).values(key=key, value=value)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[SystemConfig.key],
+        set_={"value": stmt.excluded.value, "updated_at": func.current_timestamp()},
+    )
+    db.execute(stmt)
+    if commit:
+        db.commit()
 
 
 def _parse_symbol_json(value: Optional[str]) -> List[Dict[str, str]]:
     if not value:
         return []
     try:
-        parsed = json.loads(value)
-        if isinstance(parsed, list):
-            result = []
-            for entry in parsed:
-                if not isinstance(entry, dict):
-                    continue
-                symbol = str(entry.get("symbol") or "").upper()
-                if not symbol:
-                    continue
-                result.append(
-                    {
-                        "symbol": symbol,
-                        "name": entry.get("name") or symbol,
-                        "type": entry.get("type") or entry.get("category"),
-                    }
-                )
-            return result
-    except json.JSONDecodeError:
+        parsed = fast_json.loads(value)
+    except fast_json.JSONDecodeError:
         logger.warning("Failed to decode stored Hyperliquid symbols; falling back to defaults")
-    return []
+        return []
+    if not isinstance(parsed, list):
+        return []
+
+    # Interned symbols make the frequent `symbol in available_set` checks pointer compares
+    intern = sys.intern
+    result = []
+    append = result.append
+    for entry in parsed:
+        if not isinstance(entry, dict):
+            continue
+        get = entry.get
+        symbol = str(get("symbol") or "").upper()
+        if not symbol:
+            continue
+        append({"symbol": intern(symbol), "name": get("name") or symbol, "type": get("type") or get("category")})
+    return result
 
 
 def _serialize_symbols(symbols: List[Dict[str, str]]) -> str:
     sanitized = []
+    append = sanitized.append
     seen = set()
     for entry in symbols:
-        symbol = str(entry.get("symbol") or "").upper()
+        get = entry.get
+        symbol = str(get("symbol") or "").upper()
         if not symbol or symbol in seen:
             continue
         seen.add(symbol)
-        sanitized.append(
-            {
-                "symbol": symbol,
-                "name": entry.get("name") or symbol,
-                "type": entry.get("type") or entry.get("category"),
-            }
-        )
-    return json.dumps(sanitized)
+        append({"symbol": symbol, "name": get("name") or symbol, "type": get("type") or get("category")})
+    return fast_json.dumps(sanitized)
 
 
 def _validate_symbol_tradability(symbol: str, environment: str = "testnet") -> bool:
@@ -112,13 +130,31 @@ def _validate_symbol_tradability(symbol: str, environment: str = "testnet") -> b
         return False
 
 
+def _meta_tradability(entry: Dict[str, object]) -> Optional[bool]:
+    """
+    Decide tradability from a meta universe entry without extra HTTP calls.
+
+    Returns None when the entry lacks the fields needed to decide.
+    """
+    if entry.get("isDelisted") is True:
+        return False
+    if entry.get("szDecimals") is not None:
+        return True
+    return None
+
+
 def fetch_remote_symbols(environment: str = "testnet") -> List[Dict[str, str]]:
     """Call Hyperliquid meta endpoint to retrieve tradable universe."""
     url = META_ENDPOINTS.get(environment, META_ENDPOINTS["testnet"])
     try:
-        resp = requests.post(url, json={"type": "meta"}, timeout=10)
+        resp = _SESSION.post(
+            url,
+            json={"type": "meta"},
+            headers={"Accept-Encoding": "gzip"},
+            timeout=META_REQUEST_TIMEOUT,
+        )
         resp.raise_for_status()
-        data = resp.json()
+        data = fast_json.loads(resp.content)
         universe = data.get("universe") or data.get("universeSpot") or []
     except Exception as err:
         logger.warning("Failed to fetch Hyperliquid meta info: %s", err)
@@ -139,8 +175,11 @@ def fetch_remote_symbols(environment: str = "testnet") -> List[Dict[str, str]]:
             continue
         seen.add(symbol)
 
-        # Validate symbol is actually tradable
-        if not _validate_symbol_tradability(symbol, environment):
+        # Meta already flags delisted assets; only probe entries it can't classify
+        tradable = _meta_tradability(entry)
+        if tradable is None:
+            tradable = _validate_symbol_tradability(symbol, environment)
+        if not tradable:
             logger.debug(f"Skipping symbol {symbol} (not tradable on Hyperliquid)")
             invalid_count += 1
             continue
@@ -167,112 +206,133 @@ def refresh_hyperliquid_symbols(environment: str = "testnet") -> List[Dict[str,
 
     with SessionLocal() as db:
         if remote_symbols:
-            _save_config_value(db, AVAILABLE_SYMBOLS_KEY, _serialize_symbols(remote_symbols))
+            serialized = _serialize_symbols(remote_symbols)
+            catalog_hash = hashlib.blake2b(serialized.encode(), digest_size=16).hexdigest()
+            if catalog_hash == _load_config_value(db, AVAILABLE_SYMBOLS_HASH_KEY):
+                logger.debug("Hyperliquid symbol catalog unchanged; skipping update")
+                return get_available_symbols(db)
+
+            _save_config_value(db, AVAILABLE_SYMBOLS_KEY, serialized, commit=False)
+            _save_config_value(db, AVAILABLE_SYMBOLS_HASH_KEY, catalog_hash)
             _ensure_watchlist_valid(db, remote_symbols)
+            invalidate_market_stream_symbols()
             logger.info("Hyperliquid symbol catalog refreshed (%d symbols)", len(remote_symbols))
         else:
             stored = _parse_symbol_json(_load_config_value(db, AVAILABLE_SYMBOLS_KEY))
             if not stored:
                 _save_config_value(db, AVAILABLE_SYMBOLS_KEY, _serialize_symbols(DEFAULT_SYMBOLS))
                 _ensure_watchlist_valid(db, DEFAULT_SYMBOLS)
-    return get_available_symbols()
+                invalidate_market_stream_symbols()
+        return get_available_symbols(db)
 
 
 def _ensure_watchlist_valid(db: Session, available: List[Dict[str, str]]) -> None:
     available_set = {item["symbol"] for item in available}
     raw_value = _load_config_value(db, SELECTED_SYMBOLS_KEY)
-    if not raw_value:
-        # Populate defaults
-        default = [entry["symbol"] for entry in available[:MAX_WATCHLIST_SYMBOLS]] or [
-            item["symbol"] for item in DEFAULT_SYMBOLS
-        ]
-        _save_config_value(db, SELECTED_SYMBOLS_KEY, json.dumps(default))
-        return
-
-    try:
-        symbols = json.loads(raw_value)
-        if not isinstance(symbols, list):
-            raise ValueError("Selection is not a list")
-    except Exception:
-        logger.warning("Invalid Hyperliquid watchlist stored; resetting to defaults")
-        default = [entry["symbol"] for entry in available[:MAX_WATCHLIST_SYMBOLS]] or [
-            item["symbol"] for item in DEFAULT_SYMBOLS
-        ]
-        _save_config_value(db, SELECTED_SYMBOLS_KEY, json.dumps(default))
-        return
 
-    filtered = [str(sym).upper() for sym in symbols if str(sym).upper() in available_set]
+    symbols = None
+    if raw_value:
+        try:
+            symbols = fast_json.loads(raw_value)
+            if not isinstance(symbols, list):
+                raise ValueError("Selection is not a list")
+        except Exception:
+            logger.warning("Invalid Hyperliquid watchlist stored; resetting to defaults")
+            symbols = None
 
-    if filtered:
-        _save_config_value(db, SELECTED_SYMBOLS_KEY, json.dumps(filtered[:MAX_WATCHLIST_SYMBOLS]))
-        return
+    if symbols is None:
+        # Nothing (valid) stored yet -> populate defaults
+        final_selection = None
+    elif not symbols:
+        # User intentionally cleared watchlist, keep empty
+        final_selection = []
+    else:
+        filtered = [str(sym).upper() for sym in symbols if str(sym).upper() in available_set]
+        # Previously selected symbols no longer available -> fall back to defaults
+        final_selection = filtered[:MAX_WATCHLIST_SYMBOLS] or None
 
-    if symbols:
-        # Previously selected symbols are no longer available -> fall back to defaults
-        default = [entry["symbol"] for entry in available[:MAX_WATCHLIST_SYMBOLS]] or [
+    if final_selection is None:
+        final_selection = [entry["symbol"] for entry in available[:MAX_WATCHLIST_SYMBOLS]] or [
             item["symbol"] for item in DEFAULT_SYMBOLS
         ]
-        _save_config_value(db, SELECTED_SYMBOLS_KEY, json.dumps(default))
-    else:
-        # User intentionally cleared watchlist, keep empty
-        _save_config_value(db, SELECTED_SYMBOLS_KEY, json.dumps([]))
 
+    if final_selection == symbols:
+        return
+    _save_config_value(db, SELECTED_SYMBOLS_KEY, fast_json.dumps(final_selection))
 
-def get_available_symbols() -> List[Dict[str, str]]:
+
+def get_available_symbols(db: Optional[Session] = None) -> List[Dict[str, str]]:
     """Return cached available Hyperliquid symbols."""
-    with SessionLocal() as db:
-        stored = _parse_symbol_json(_load_config_value(db, AVAILABLE_SYMBOLS_KEY))
-        if stored:
-            return stored
-        # Seed defaults if missing
-        _save_config_value(db, AVAILABLE_SYMBOLS_KEY, _serialize_symbols(DEFAULT_SYMBOLS))
-        _ensure_watchlist_valid(db, DEFAULT_SYMBOLS)
-        return DEFAULT_SYMBOLS.copy()
+    if db is None:
+        with SessionLocal() as db:
+            return get_available_symbols(db)
 
+    stored = _parse_symbol_json(_load_config_value(db, AVAILABLE_SYMBOLS_KEY))
+    if stored:
+        return stored
+    # Seed defaults if missing
+    _save_config_value(db, AVAILABLE_SYMBOLS_KEY, _serialize_symbols(DEFAULT_SYMBOLS))
+    _ensure_watchlist_valid(db, DEFAULT_SYMBOLS)
+    return DEFAULT_SYMBOLS.copy()
 
-def get_available_symbols_info() -> Dict[str, Optional[str]]:
+
+def get_available_symbols_info(db: Optional[Session] = None) -> Dict[str, Optional[str]]:
     """Return available symbols plus last update timestamp."""
-    with SessionLocal() as db:
-        config = db.query(SystemConfig).filter(SystemConfig.key == AVAILABLE_SYMBOLS_KEY).first()
-        symbols = _parse_symbol_json(config.value if config else None)
-        updated_at = config.updated_at.isoformat() if config and config.updated_at else None
-        if not symbols:
-            symbols = DEFAULT_SYMBOLS.copy()
-        return {"symbols": symbols, "updated_at": updated_at}
+    if db is None:
+        with SessionLocal() as db:
+            return get_available_symbols_info(db)
 
+    config = db.query(SystemConfig).filter(SystemConfig.key == AVAILABLE_SYMBOLS_KEY).first()
+    symbols = _parse_symbol_json(config.value if config else None)
+    updated_at = config.updated_at.isoformat() if config and config.updated_at else None
+    if not symbols:
+        symbols = DEFAULT_SYMBOLS.copy()
+    return {"symbols": symbols, "updated_at": updated_at}
 
-def get_available_symbol_map() -> Dict[str, Dict[str, str]]:
+
+def get_available_symbol_map(db: Optional[Session] = None) -> Dict[str, Dict[str, str]]:
     """Return mapping of symbol -> metadata."""
-    return {entry["symbol"]: entry for entry in get_available_symbols()}
+    return {entry["symbol"]: entry for entry in get_available_symbols(db)}
 
 
-def get_selected_symbols() -> List[str]:
-    """Return user-selected Hyperliquid symbols."""
-    with SessionLocal() as db:
-        raw_value = _load_config_value(db, SELECTED_SYMBOLS_KEY)
-        try:
-            selected = json.loads(raw_value) if raw_value else []
-        except json.JSONDecodeError:
-            selected = []
-
-        available_set = {entry["symbol"] for entry in get_available_symbols()}
-        filtered = [
-            str(symbol).upper()
-            for symbol in selected
-            if str(symbol).upper() in available_set
-        ]
+def get_symbol_selection(
+    db: Optional[Session] = None,
+) -> Tuple[List[Dict[str, str]], List[str]]:
+    """Return (available symbols, user-selected symbols) read within one session."""
+    if db is None:
+        with SessionLocal() as db:
+            return get_symbol_selection(db)
 
-        if filtered:
-            return filtered[:MAX_WATCHLIST_SYMBOLS]
+    available = get_available_symbols(db)
+    raw_value = _load_config_value(db, SELECTED_SYMBOLS_KEY)
+    try:
+        selected = fast_json.loads(raw_value) if raw_value else []
+    except fast_json.JSONDecodeError:
+        selected = []
 
-        if raw_value:
-            # User explicitly saved empty list or all selections invalid -> return empty
-            return []
+    available_set = {entry["symbol"] for entry in available}
+    filtered = [
+        str(symbol).upper()
+        for symbol in selected
+        if str(symbol).upper() in available_set
+    ]
+
+    if filtered:
+        return available, filtered[:MAX_WATCHLIST_SYMBOLS]
 
-        # If nothing stored yet, default to first few
-        default = [entry["symbol"] for entry in get_available_symbols()[:MAX_WATCHLIST_SYMBOLS]]
-        _save_config_value(db, SELECTED_SYMBOLS_KEY, json.dumps(default))
-        return default
+    if raw_value:
+        # User explicitly saved empty list or all selections invalid -> return empty
+        return available, []
+
+    # If nothing stored yet, default to first few
+    default = [entry["symbol"] for entry in available[:MAX_WATCHLIST_SYMBOLS]]
+    _save_config_value(db, SELECTED_SYMBOLS_KEY, fast_json.dumps(default))
+    return available, default
+
+
+def get_selected_symbols(db: Optional[Session] = None) -> List[str]:
+    """Return user-selected Hyperliquid symbols."""
+    return get_symbol_selection(db)[1]
 
 
 def update_selected_symbols(symbols: List[str]) -> List[str]:
@@ -289,23 +349,24 @@ def update_selected_symbols(symbols: List[str]) -> List[str]:
     if len(unique_symbols) > MAX_WATCHLIST_SYMBOLS:
         raise ValueError(f"Cannot monitor more than {MAX_WATCHLIST_SYMBOLS} symbols")
 
-    available_set = {entry["symbol"] for entry in get_available_symbols()}
-    invalid = [symbol for symbol in unique_symbols if symbol not in available_set]
-    if invalid:
-        raise ValueError(f"Unsupported Hyperliquid symbols: {', '.join(invalid)}")
-
     with SessionLocal() as db:
-        _save_config_value(db, SELECTED_SYMBOLS_KEY, json.dumps(unique_symbols))
+        available_set = {entry["symbol"] for entry in get_available_symbols(db)}
+        invalid = [symbol for symbol in unique_symbols if symbol not in available_set]
+        if invalid:
+            raise ValueError(f"Unsupported Hyperliquid symbols: {', '.join(invalid)}")
+
+        _save_config_value(db, SELECTED_SYMBOLS_KEY, fast_json.dumps(unique_symbols))
+    invalidate_market_stream_symbols()
 
     logger.info("Hyperliquid watchlist updated: %s", ", ".join(unique_symbols) or "none")
     refresh_market_stream_symbols()
     return unique_symbols
 
 
-def get_symbol_display(symbol: str) -> str:
+def get_symbol_display(symbol: str, db: Optional[Session] = None) -> str:
     """Friendly display name for symbol."""
     symbol_upper = symbol.upper()
-    metadata = get_available_symbol_map()
+    metadata = get_available_symbol_map(db)
     entry = metadata.get(symbol_upper)
     if entry:
         return entry.get("name") or symbol_upper
@@ -332,26 +393,29 @@ def schedule_symbol_refresh_task(interval_seconds: int = 7200) -> None:
     )
 
 
-def _has_active_paper_accounts() -> bool:
+def _has_active_paper_accounts(db: Session) -> bool:
     """Return True if any active AI account is still running in paper mode."""
-    with SessionLocal() as db:
-        paper_account = (
-            db.query(Account.id)
-            .filter(
-                Account.is_active == "true",
-                Account.auto_trading_enabled == "true",
-                Account.account_type == "AI",
-                Account.hyperliquid_environment.is_(None),
-            )
-            .first()
-        )
-        return paper_account is not None
+    paper_accounts = db.query(Account.id).filter(
+        Account.is_active == "true",
+        Account.auto_trading_enabled == "true",
+        Account.account_type == "AI",
+        Account.hyperliquid_environment.is_(None),
+    )
+    return bool(db.query(paper_accounts.exists()).scalar())
 
 
-def build_market_stream_symbols() -> List[str]:
+def build_market_stream_symbols(db: Optional[Session] = None) -> List[str]:
     """Compute the combined set of symbols for the shared market data stream."""
+    version = _STREAM_CACHE["version"]
+    if _STREAM_CACHE["calc_version"] == version and _STREAM_CACHE["symbols"] is not None:
+        return list(_STREAM_CACHE["symbols"])
+
+    if db is None:
+        with SessionLocal() as db:
+            return build_market_stream_symbols(db)
+
     paper_symbols: List[str] = []
-    if _has_active_paper_accounts():
+    if _has_active_paper_accounts(db):
         try:
             from services.trading_commands import AI_TRADING_SYMBOLS
         except Exception:
@@ -359,8 +423,10 @@ def build_market_stream_symbols() -> List[str]:
         else:
             paper_symbols = list(AI_TRADING_SYMBOLS)
 
-    combined = sorted(set(paper_symbols + get_selected_symbols()))
-    return combined
+    combined = sorted(set(paper_symbols + get_selected_symbols(db)))
+    _STREAM_CACHE["symbols"] = combined
+    _STREAM_CACHE["calc_version"] = version
+    return list(combined)
 
 
 def refresh_market_stream_symbols() -> List[str]:
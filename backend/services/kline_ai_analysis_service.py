@@ -1,23 +1,92 @@
 """
 K-line AI Analysis Service - Handles AI-powered chart analysis
 """
+import functools
 import logging
 import json
 import time
 import random
+import re
+import string
+import threading
+from collections import OrderedDict
 from datetime import datetime
-from typing import Any, Dict, List, Optional
+from typing import Any, Dict, List, Optional, Tuple
 
+import numpy as np
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3 import exceptions as urllib3_exceptions
 from sqlalchemy.orm import Session
 
 from database.models import Account, KlineAIAnalysisLog
 from config.prompt_templates import KLINE_ANALYSIS_PROMPT_TEMPLATE
 from services.ai_decision_service import build_chat_completion_endpoints, _extract_text_from_message
+from utils import fast_json
+
+try:
+    import ijson
+except ImportError:  # without ijson, responses are parsed after the full download
+    ijson = None
+
+# Errors raised while a streamed body is read from response.raw; these bypass requests'
+# exception wrapping, so they are retried explicitly like a read timeout
+_STREAM_READ_ERRORS = (
+    urllib3_exceptions.ReadTimeoutError,
+    urllib3_exceptions.ProtocolError,
+    urllib3_exceptions.DecodeError,
+) + ((ijson.JSONError,) if ijson is not None else ())
 
 
 logger = logging.getLogger(__name__)
 
+# Shared HTTP session: keep-alive connections are reused across retries, endpoints
+# and concurrent analyses instead of paying a TCP+TLS handshake per request
+_SESSION = requests.Session()
+_SESSION.mount("https://", HTTPAdapter(pool_connections=16, pool_maxsize=64, max_retries=0))
+_SESSION.mount("http://", HTTPAdapter(pool_connections=16, pool_maxsize=64, max_retries=0))
+
+
+# Connect phase gets its own short timeout so an unreachable endpoint fails in seconds,
+# not after the long read timeout reserved for slow reasoning models
+AI_CONNECT_TIMEOUT = 10
+
+
+def _is_connect_failure(exc: requests.ConnectionError) -> bool:
+    """True when no connection was established (connect timeout, refused, DNS failure)"""
+    if isinstance(exc, requests.ConnectTimeout):
+        return True
+    # A dropped connection mid-response is also a ConnectionError, but wraps a ProtocolError
+    reason = getattr(exc.args[0], "reason", None) if exc.args else None
+    return isinstance(reason, urllib3_exceptions.NewConnectionError)
+
+# Model name markers for request parameter selection
+_REASONING_MARKERS = (
+    "gpt-5", "o1-preview", "o1-mini", "o1-", "o3-", "o4-",
+    "deepseek-r1", "deepseek-reasoner",
+    "qwq", "qwen-plus-thinking", "qwen-max-thinking", "qwen3-thinking",
+    "claude-4", "claude-sonnet-4-5",
+    "gemini-2.5", "gemini-3", "gemini-2.0-flash-thinking",
+    "grok-3-mini",
+)
+_NEW_MARKERS = ("gpt-4o",)
+_REASONING_RE = re.compile("|".join(map(re.escape, _REASONING_MARKERS)))
+_NEW_RE = re.compile("|".join(map(re.escape, _NEW_MARKERS)))
+
+
+@functools.lru_cache(maxsize=256)
+def _classify_model(model_lower: str) -> Tuple[bool, bool]:
+    """Return (is_reasoning_model, is_new_model) for a lower-cased model name"""
+    is_reasoning_model = _REASONING_RE.search(model_lower) is not None
+    is_new_model = is_reasoning_model or _NEW_RE.search(model_lower) is not None
+    return is_reasoning_model, is_new_model
+
+
+@functools.lru_cache(maxsize=256)
+def _chat_completion_endpoints(base_url: Optional[str], model: Optional[str]) -> Tuple[str, ...]:
+    """Cached build_chat_completion_endpoints; a tuple so the shared result can't be mutated"""
+    return tuple(build_chat_completion_endpoints(base_url, model))
+
 
 class SafeDict(dict):
     """Dictionary that returns 'N/A' for missing keys"""
@@ -25,8 +94,116 @@ class SafeDict(dict):
         return "N/A"
 
 
-def _format_klines_summary(klines: List[Dict]) -> str:
-    """Format K-line data into a readable summary"""
+def _parse_prompt_template(template: str) -> Optional[List[Tuple]]:
+    """
+    Split template into (literal, field, spec, conversion) parts for _render_kline_prompt
+
+    Returns None when the template is malformed or uses fields that are not plain keys
+    (attribute/index access, nested specs); rendering then falls back to format_map.
+    """
+    try:
+        parts = list(string.Formatter().parse(template))
+    except ValueError:
+        return None
+    for _, field, spec, _ in parts:
+        if field is not None and (not field.isidentifier() or "{" in (spec or "")):
+            return None
+    return parts
+
+
+# Template is parsed once at import; rendering only joins literals and field values
+_KLINE_PROMPT_PARTS = _parse_prompt_template(KLINE_ANALYSIS_PROMPT_TEMPLATE)
+_CONVERSIONS = {"r": repr, "s": str, "a": ascii}
+
+
+def _render_kline_prompt(context: Dict[str, Any]) -> str:
+    """Equivalent to KLINE_ANALYSIS_PROMPT_TEMPLATE.format_map(SafeDict(context))"""
+    mapping = SafeDict(context)
+    if _KLINE_PROMPT_PARTS is None:
+        return KLINE_ANALYSIS_PROMPT_TEMPLATE.format_map(mapping)
+    parts = []
+    for literal, field, spec, conversion in _KLINE_PROMPT_PARTS:
+        parts.append(literal)
+        if field is not None:
+            value = mapping[field]
+            if conversion:
+                value = _CONVERSIONS[conversion](value)
+            parts.append(format(value, spec or ""))
+    return "".join(parts)
+
+
+def _fmt_ts_minute(ts: float) -> str:
+    """UTC 'YYYY-MM-DD HH:MM' for a unix timestamp, without allocating a datetime"""
+    g = time.gmtime(ts)
+    if g.tm_year > 9999:
+        # Same range as datetime, so e.g. millisecond timestamps still fall back to str(ts)
+        raise ValueError(f"year {g.tm_year} is out of range")
+    return "%04d-%02d-%02d %02d:%02d" % (g.tm_year, g.tm_mon, g.tm_mday, g.tm_hour, g.tm_min)
+
+
+_SOA_FIELDS = ("open", "high", "low", "close", "volume")
+
+# LRU of formatted K-line summaries keyed by symbol/period/candle window
+KLINES_SUMMARY_CACHE_SIZE = 128
+_KLINES_SUMMARY_CACHE: "OrderedDict[Tuple, str]" = OrderedDict()
+_KLINES_SUMMARY_LOCK = threading.Lock()
+
+
+def _klines_to_soa(klines: List[Dict]) -> Dict[str, np.ndarray]:
+    """Convert list-of-dict candles into float64 column arrays (missing values -> 0)"""
+    # One pass over the candles; the row matrix is then split into contiguous columns
+    matrix = np.array(
+        [
+            (k.get("open") or 0, k.get("high") or 0, k.get("low") or 0, k.get("close") or 0, k.get("volume") or 0)
+            for k in klines
+        ],
+        dtype=np.float64,
+    ).reshape(-1, len(_SOA_FIELDS))
+    columns = np.ascontiguousarray(matrix.T)
+    return dict(zip(_SOA_FIELDS, columns))
+
+
+def _format_klines_summary(
+    klines: List[Dict],
+    symbol: Optional[str] = None,
+    period: Optional[str] = None,
+) -> str:
+    """
+    Format K-line data into a readable summary.
+
+    When symbol and period are given, the result is cached so repeated analyses of the
+    same candle window reuse the formatted text.
+    """
+    if not klines or symbol is None or period is None:
+        return _build_klines_summary(klines)
+
+    first, last = klines[0], klines[-1]
+    # Earlier candles are closed; the newest may still be forming, so its values are
+    # part of the key and every price update produces a new entry
+    key = (
+        symbol,
+        period,
+        len(klines),
+        first.get('timestamp') or first.get('time'),
+        last.get('timestamp') or last.get('time'),
+        tuple(last.get(field) for field in _SOA_FIELDS),
+    )
+    with _KLINES_SUMMARY_LOCK:
+        cached = _KLINES_SUMMARY_CACHE.get(key)
+        if cached is not None:
+            _KLINES_SUMMARY_CACHE.move_to_end(key)
+            return cached
+
+    summary = _build_klines_summary(klines)
+    with _KLINES_SUMMARY_LOCK:
+        _KLINES_SUMMARY_CACHE[key] = summary
+        while len(_KLINES_SUMMARY_CACHE) > KLINES_SUMMARY_CACHE_SIZE:
+            _KLINES_SUMMARY_CACHE.popitem(last=False)
+    return summary
+
+
+def _build_klines_summary(klines: List[Dict]) -> str:
+    """Format K-line data into a readable summary (uncached)"""
     if not klines:
         return "No K-line data available."
 
@@ -37,12 +214,30 @@ def _format_klines_summary(klines: List[Dict]) -> str:
     lines.append(f"Displaying last {len(recent_klines)} candles (oldest to newest):")
     lines.append("")
 
-    for i, kline in enumerate(recent_klines):
+    columns = _klines_to_soa(recent_klines)
+    opens = columns["open"]
+    highs = columns["high"]
+    lows = columns["low"]
+    closes = columns["close"]
+    volumes = columns["volume"]
+
+    # Change % computed for all rows at once; formatting runs over plain Python floats
+    safe_opens = np.where(opens > 0, opens, 1.0)
+    change_pcts = np.abs(np.where(opens > 0, (closes - opens) / safe_opens * 100.0, 0.0))
+
+    for kline, open_price, high, low, close, volume, change_pct in zip(
+        recent_klines,
+        opens.tolist(),
+        highs.tolist(),
+        lows.tolist(),
+        closes.tolist(),
+        volumes.tolist(),
+        change_pcts.tolist(),
+    ):
         timestamp = kline.get('timestamp') or kline.get('time', 'N/A')
         if isinstance(timestamp, (int, float)):
             try:
-                dt = datetime.utcfromtimestamp(timestamp)
-                time_str = dt.strftime('%Y-%m-%d %H:%M')
+                time_str = _fmt_ts_minute(timestamp)
             except:
                 time_str = str(timestamp)
         elif kline.get('datetime'):
@@ -51,28 +246,20 @@ def _format_klines_summary(klines: List[Dict]) -> str:
         else:
             time_str = 'N/A'
 
-        open_price = kline.get('open') or 0
-        high = kline.get('high') or 0
-        low = kline.get('low') or 0
-        close = kline.get('close') or 0
-        volume = kline.get('volume') or 0
-
-        # Determine candle direction
         direction = "+" if close >= open_price else "-"
-        change_pct = ((close - open_price) / open_price * 100) if open_price > 0 else 0
-
         lines.append(
             f"[{time_str}] O:{open_price:.2f} H:{high:.2f} L:{low:.2f} C:{close:.2f} "
-            f"({direction}{abs(change_pct):.2f}%) Vol:{volume:,.0f}"
+            f"({direction}{change_pct:.2f}%) Vol:{volume:,.0f}"
         )
 
     # Add summary statistics
     if len(klines) >= 2:
-        first_close = klines[0].get('close') or 0
-        last_close = klines[-1].get('close') or 0
-        highest = max((k.get('high') or 0) for k in klines)
-        lowest = min((k.get('low') or float('inf')) for k in klines)
-        total_volume = sum((k.get('volume') or 0) for k in klines)
+        first_close = float(closes[0])
+        last_close = float(closes[-1])
+        highest = float(highs.max())
+        positive_lows = lows[lows > 0]
+        lowest = float(positive_lows.min()) if positive_lows.size else 0.0
+        total_volume = float(volumes.sum())
 
         if first_close > 0:
             period_change = ((last_close - first_close) / first_close) * 100
@@ -137,7 +324,7 @@ def _format_indicators_summary(indicators: Dict[str, Any]) -> str:
                 latest = values[-1] if values[-1] is not None else 'N/A'
                 ma_indicators.append(f"{key}: ${latest:.2f}" if isinstance(latest, (int, float)) else f"{key}: {latest}")
                 # 最近序列
-                tail_values = [v for v in values[-tail_len:] if isinstance(v, (int, float, float))]
+                tail_values = [v for v in values[-tail_len:] if isinstance(v, (int, float))]
                 if tail_values:
                     ma_indicators.append(f"{key} last {len(tail_values)}: {', '.join(f'{v:.2f}' for v in tail_values)}")
 
@@ -179,7 +366,7 @@ def _format_indicators_summary(indicators: Dict[str, Any]) -> str:
                 hist_val = histogram[-1]
                 trend = "Bullish momentum" if hist_val > 0 else "Bearish momentum"
                 lines.append(f"Histogram: {hist_val:.4f} ({trend})")
-                tail_hist = [v for v in histogram[-tail_len:] if isinstance(v, (int, float, float))]
+                tail_hist = [v for v in histogram[-tail_len:] if isinstance(v, (int, float))]
                 if tail_hist:
                     lines.append(f"Histogram last {len(tail_hist)}: {', '.join(f'{v:.4f}' for v in tail_hist)}")
             lines.append("")
@@ -215,6 +402,22 @@ def _format_indicators_summary(indicators: Dict[str, Any]) -> str:
     return "\n".join(lines)
 
 
+def _parse_streamed_completion(response: requests.Response) -> Dict[str, Any]:
+    """
+    Incrementally parse a streamed chat-completion body with ijson.
+
+    Returns as soon as the first choice (message content + finish_reason) is complete,
+    shaped like the regular JSON response so callers can treat both the same way.
+    """
+    try:
+        response.raw.decode_content = True
+        for choice in ijson.items(response.raw, "choices.item"):
+            return {"choices": [choice]}
+        return {"choices": []}
+    finally:
+        response.close()
+
+
 def analyze_kline_chart(
     db: Session,
     account: Account,
@@ -262,7 +465,7 @@ def analyze_kline_chart(
         # respect kline_limit if provided
         display_klines = klines[-kline_limit:] if kline_limit else klines
 
-        klines_summary = _format_klines_summary(display_klines)
+        klines_summary = _format_klines_summary(display_klines, symbol, period)
         indicators_summary = _format_indicators_summary(indicators)
         positions_summary = _format_positions_summary(positions or [])
 
@@ -285,7 +488,7 @@ def analyze_kline_chart(
 
         # Render prompt
         try:
-            prompt = KLINE_ANALYSIS_PROMPT_TEMPLATE.format_map(SafeDict(context))
+            prompt = _render_kline_prompt(context)
         except Exception as e:
             logger.error(f"Failed to render prompt: {e}")
             prompt = KLINE_ANALYSIS_PROMPT_TEMPLATE
@@ -297,18 +500,7 @@ def analyze_kline_chart(
         }
 
         model_lower = (account.model or "").lower()
-        is_reasoning_model = any(
-            marker in model_lower for marker in [
-                "gpt-5", "o1-preview", "o1-mini", "o1-", "o3-", "o4-",
-                "deepseek-r1", "deepseek-reasoner",
-                "qwq", "qwen-plus-thinking", "qwen-max-thinking", "qwen3-thinking",
-                "claude-4", "claude-sonnet-4-5",
-                "gemini-2.5", "gemini-3", "gemini-2.0-flash-thinking",
-                "grok-3-mini"
-            ]
-        )
-
-        is_new_model = is_reasoning_model or any(marker in model_lower for marker in ["gpt-4o"])
+        is_reasoning_model, is_new_model = _classify_model(model_lower)
 
         payload = {
             "model": account.model,
@@ -329,15 +521,20 @@ def analyze_kline_chart(
             payload["max_tokens"] = 4000
 
         # Call AI API
-        endpoints = build_chat_completion_endpoints(account.base_url, account.model)
+        endpoints = _chat_completion_endpoints(account.base_url, account.model)
         if not endpoints:
             logger.error(f"No valid API endpoint for account {account.name}")
             return {"error": "Failed to build API endpoint"}
 
         max_retries = 3
         response = None
+        result = None
         success = False
         request_timeout = 600  # 10 minutes for all models (reasoning models can be very slow)
+        # Long reasoning replies are parsed while they arrive instead of after the full download
+        stream_response = is_reasoning_model and ijson is not None
+        # Serialize the prompt once for all attempts; requests' json= would re-encode it each time
+        request_body = fast_json.dumps_bytes(payload)
 
         logger.info(f"[K-line AI API] Starting AI API call: model={account.model}, timeout={request_timeout}s, "
                    f"endpoints={len(endpoints)}, max_retries={max_retries}")
@@ -350,33 +547,62 @@ def analyze_kline_chart(
                     api_start = time.time()
                     logger.info(f"[K-line AI API] Sending request (attempt {attempt + 1}/{max_retries})...")
 
-                    response = requests.post(
+                    response = _SESSION.post(
                         endpoint,
                         headers=headers,
-                        json=payload,
-                        timeout=request_timeout,
+                        timeout=(AI_CONNECT_TIMEOUT, request_timeout),
                         verify=False,
+                        stream=stream_response,
+                        data=request_body,
                     )
 
                     api_elapsed = time.time() - api_start
+                    # Streamed bodies are read by the parser, so only report the advertised length
+                    content_length = (
+                        response.headers.get("Content-Length", "streamed") if stream_response
+                        else len(response.content) if response.content else 0
+                    )
                     logger.info(f"[K-line AI API] Received response in {api_elapsed:.2f}s: status={response.status_code}, "
-                               f"content_length={len(response.content) if response.content else 0}")
+                               f"content_length={content_length}")
 
                     if response.status_code == 200:
+                        # Streamed bodies are read here so mid-body failures are retried below
+                        if stream_response:
+                            result = _parse_streamed_completion(response)
+                        else:
+                            result = fast_json.loads(response.content)
                         success = True
-                        logger.info(f"[K-line AI API] Success! Total API time: {api_elapsed:.2f}s")
+                        logger.info(f"[K-line AI API] Success! Total API time: {time.time() - api_start:.2f}s")
                         break
 
                     if response.status_code == 429:
                         wait_time = (2**attempt) + random.uniform(0, 1)
                         logger.info(f"[K-line AI API] Rate limited (429), waiting {wait_time:.1f}s...")
                         if attempt < max_retries - 1:
+                            # An unread streamed body would keep the pooled connection checked out
+                            response.close()
                             time.sleep(wait_time)
                             continue
 
                     logger.info(f"[K-line AI API] API returned error status {response.status_code}: {response.text[:200]}")
                     break
 
+                except requests.ConnectionError as e:
+                    api_elapsed = time.time() - api_start
+                    if _is_connect_failure(e) and endpoint_idx < len(endpoints) - 1:
+                        # Endpoint unreachable: fail over now instead of backing off on it
+                        logger.warning(f"[K-line AI API] Could not connect after {api_elapsed:.2f}s: {e}; "
+                                       f"trying next endpoint")
+                        break
+                    logger.error(f"[K-line AI API] Connection failed after {api_elapsed:.2f}s: {type(e).__name__}: {e}")
+                    if attempt < max_retries - 1:
+                        wait_time = (2**attempt) + random.uniform(0, 1)
+                        logger.info(f"[K-line AI API] Retrying in {wait_time:.1f}s...")
+                        time.sleep(wait_time)
+                        continue
+                    logger.error(f"[K-line AI API] Failed after {max_retries} attempts")
+                    break
+
                 except requests.Timeout as e:
                     api_elapsed = time.time() - api_start
                     logger.error(f"[K-line AI API] Request timeout after {api_elapsed:.2f}s (configured: {request_timeout}s): {e}")
@@ -388,6 +614,17 @@ def analyze_kline_chart(
                     logger.error(f"[K-line AI API] Timeout after {max_retries} attempts")
                     break
 
+                except _STREAM_READ_ERRORS as e:
+                    api_elapsed = time.time() - api_start
+                    logger.error(f"[K-line AI API] Response body failed after {api_elapsed:.2f}s: {type(e).__name__}: {e}")
+                    if attempt < max_retries - 1:
+                        wait_time = (2**attempt) + random.uniform(0, 1)
+                        logger.info(f"[K-line AI API] Retrying in {wait_time:.1f}s...")
+                        time.sleep(wait_time)
+                        continue
+                    logger.error(f"[K-line AI API] Incomplete response after {max_retries} attempts")
+                    break
+
                 except requests.RequestException as e:
                     api_elapsed = time.time() - api_start
                     logger.error(f"[K-line AI API] Request failed after {api_elapsed:.2f}s: {type(e).__name__}: {e}")
@@ -402,13 +639,10 @@ def analyze_kline_chart(
             if success:
                 break
 
-        if not success or not response:
+        if not success or result is None:
             logger.error(f"[K-line AI API] All API endpoints failed for account {account.name}")
             return {"error": "AI API request failed"}
 
-        # Parse response
-        result = response.json()
-
         if "choices" in result and len(result["choices"]) > 0:
             choice = result["choices"][0]
             message = choice.get("message", {})
@@ -432,23 +666,29 @@ def analyze_kline_chart(
                 analysis_result=analysis_text,
             )
 
+            # id and created_at come back from INSERT ... RETURNING on flush; read them
+            # before commit expires the instance so no follow-up SELECT is needed
             db.add(analysis_log)
+            db.flush()
+            analysis_id = analysis_log.id
+            created_at = analysis_log.created_at
+            model_name = account.model
+            trader_name = account.name
             db.commit()
-            db.refresh(analysis_log)
 
             total_elapsed = time.time() - analysis_start
             logger.info(f"[K-line Analysis] Analysis completed successfully in {total_elapsed:.2f}s: "
-                       f"symbol={symbol}, period={period}, account={account.name}, analysis_id={analysis_log.id}")
+                       f"symbol={symbol}, period={period}, account={trader_name}, analysis_id={analysis_id}")
 
             return {
                 "success": True,
-                "analysis_id": analysis_log.id,
+                "analysis_id": analysis_id,
                 "symbol": symbol,
                 "period": period,
-                "model": account.model,
-                "trader_name": account.name,
+                "model": model_name,
+                "trader_name": trader_name,
                 "analysis": analysis_text,
-                "created_at": analysis_log.created_at.isoformat() if analysis_log.created_at else None,
+                "created_at": created_at.isoformat() if created_at else None,
                 "prompt": prompt,
             }
 
@@ -2,16 +2,18 @@
 K线数据采集器 - 交易所分流架构
 """
 
+import bisect
+import time
 from abc import ABC, abstractmethod
-from typing import List, Optional
+from typing import Dict, List, Optional
 from datetime import datetime
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 import logging
 
 logger = logging.getLogger(__name__)
 
 
-@dataclass
+@dataclass(slots=True, frozen=True)
 class KlineData:
     """标准化的K线数据结构"""
     exchange: str
@@ -23,6 +25,16 @@ class KlineData:
     low_price: float
     close_price: float
     volume: float
+    # UTC "YYYY-MM-DD HH:MM:SS", derived once from timestamp for the storage layer
+    datetime_str: str = field(init=False, repr=False, compare=False)
+
+    def __post_init__(self):
+        t = time.gmtime(self.timestamp)
+        object.__setattr__(
+            self,
+            'datetime_str',
+            f"{t.tm_year:04d}-{t.tm_mon:02d}-{t.tm_mday:02d} {t.tm_hour:02d}:{t.tm_min:02d}:{t.tm_sec:02d}",
+        )
 
 
 class BaseKlineCollector(ABC):
@@ -59,9 +71,9 @@ class HyperliquidKlineCollector(BaseKlineCollector):
 
     def __init__(self):
         super().__init__("hyperliquid")
-        # 复用现有的 hyperliquid_market_data 服务
-        from .hyperliquid_market_data import HyperliquidClient
-        self.market_data = HyperliquidClient()
+        # 复用现有的 hyperliquid_market_data 服务（共享已缓存的 mainnet 客户端）
+        from .hyperliquid_market_data import get_hyperliquid_client_for_environment
+        self.market_data = get_hyperliquid_client_for_environment("mainnet")
 
     async def fetch_current_kline(self, symbol: str, period: str = "1m") -> Optional[KlineData]:
         """获取当前分钟K线"""
@@ -109,23 +121,25 @@ class HyperliquidKlineCollector(BaseKlineCollector):
                 symbol, period, count=min(limit, 5000)
             )
 
-            result = []
-            for kline in klines:
-                kline_time = datetime.fromtimestamp(kline['timestamp'])
-                if start_time <= kline_time <= end_time:
-                    result.append(KlineData(
-                        exchange=self.exchange_id,
-                        symbol=symbol,
-                        timestamp=int(kline['timestamp']),
-                        period=period,
-                        open_price=float(kline['open']),
-                        high_price=float(kline['high']),
-                        low_price=float(kline['low']),
-                        close_price=float(kline['close']),
-                        volume=float(kline['volume'])
-                    ))
-
-            return result
+            # OHLCV数据按时间升序返回，用二分查找定位区间，只为区间内的K线构造对象
+            timestamps = [int(kline['timestamp']) for kline in klines]
+            start_idx = bisect.bisect_left(timestamps, start_time.timestamp())
+            end_idx = bisect.bisect_right(timestamps, end_time.timestamp())
+
+            return [
+                KlineData(
+                    exchange=self.exchange_id,
+                    symbol=symbol,
+                    timestamp=timestamps[idx],
+                    period=period,
+                    open_price=float(kline['open']),
+                    high_price=float(kline['high']),
+                    low_price=float(kline['low']),
+                    close_price=float(kline['close']),
+                    volume=float(kline['volume'])
+                )
+                for idx, kline in enumerate(klines[start_idx:end_idx], start_idx)
+            ]
         except Exception as e:
             self.logger.error(f"Failed to fetch historical klines for {symbol}: {e}")
             return []
@@ -204,15 +218,19 @@ class ExchangeDataSourceFactory:
         "binance": BinanceKlineCollector,
         "aster": AsterKlineCollector
     }
+    _instances: Dict[str, BaseKlineCollector] = {}
 
     @classmethod
     def get_collector(cls, exchange_id: str) -> BaseKlineCollector:
-        """根据交易所ID获取对应的采集器实例"""
+        """根据交易所ID获取对应的采集器实例（按交易所复用）"""
         if exchange_id not in cls._collectors:
             raise ValueError(f"Unsupported exchange: {exchange_id}")
 
-        collector_class = cls._collectors[exchange_id]
-        return collector_class()
+        collector = cls._instances.get(exchange_id)
+        if collector is None:
+            collector = cls._collectors[exchange_id]()
+            cls._instances[exchange_id] = collector
+        return collector
 
     @classmethod
     def get_supported_exchanges(cls) -> List[str]:
@@ -3,10 +3,19 @@ K线数据统一服务层 - 提供统一的数据操作接口
 """
 
 import asyncio
-from datetime import datetime, timedelta
-from typing import List, Optional, Dict, Any
+import csv
+import io
+import threading
+from collections import OrderedDict
+from datetime import datetime
+from operator import attrgetter
+from typing import Iterable, List, Mapping, Optional, Dict, Any, Sequence, Tuple
+
+import numpy as np
 from sqlalchemy.orm import Session
 from sqlalchemy import text
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.dialects.postgresql import insert as pg_insert
 import logging
 
 from database.connection import SessionLocal
@@ -15,6 +24,46 @@ from .kline_collectors import ExchangeDataSourceFactory, BaseKlineCollector, Kli
 
 logger = logging.getLogger(__name__)
 
+# crypto_klines 唯一约束列，用于 ON CONFLICT 去重
+KLINE_CONFLICT_COLUMNS = ('exchange', 'symbol', 'market', 'period', 'timestamp', 'environment')
+# 达到该行数时改用 COPY 写入临时表
+KLINE_COPY_THRESHOLD = 500
+KLINE_COPY_COLUMNS = (
+    'exchange', 'symbol', 'market', 'timestamp', 'period', 'datetime_str',
+    'open_price', 'high_price', 'low_price', 'close_price', 'volume', 'environment',
+)
+
+# 预先构造的 INSERT 语句：参数以列表传入（executemany），SQL 文本与批次大小无关，
+# 编译结果可命中 SQLAlchemy 的语句缓存，驱动层再按页合并为多行 VALUES
+_KLINE_INSERT = pg_insert(CryptoKline)
+_KLINE_INSERT_IGNORE_CONFLICTS = pg_insert(CryptoKline).on_conflict_do_nothing(
+    index_elements=KLINE_CONFLICT_COLUMNS
+)
+
+_KLINE_SORT_KEY = attrgetter('exchange', 'symbol', 'period', 'timestamp')
+
+# 进程内去重缓存的最大条目数
+RECENT_KLINE_KEYS_LIMIT = 10000
+
+
+def _kline_row(kline: KlineData) -> Dict[str, Any]:
+    """KlineData 转为 crypto_klines 插入参数"""
+    # NOTE: K线数据库只存储 mainnet 数据，testnet 数据实时获取不存储
+    return {
+        'exchange': kline.exchange,
+        'symbol': kline.symbol,
+        'market': 'CRYPTO',
+        'timestamp': kline.timestamp,
+        'period': kline.period,
+        'datetime_str': kline.datetime_str,
+        'open_price': kline.open_price,
+        'high_price': kline.high_price,
+        'low_price': kline.low_price,
+        'close_price': kline.close_price,
+        'volume': kline.volume,
+        'environment': 'mainnet',
+    }
+
 
 class KlineDataService:
     """K线数据统一服务 - 启动时确定交易所，后续不再判断"""
@@ -23,6 +72,13 @@ class KlineDataService:
         self.exchange_id: Optional[str] = None
         self.collector: Optional[BaseKlineCollector] = None
         self._initialized = False
+        # 乐观插入统计：fallback 比例应接近 0
+        self._insert_batch_count = 0
+        self._insert_fallback_count = 0
+        self._insert_stats_lock = threading.Lock()
+        # 最近写入的 (exchange, symbol, period, timestamp)，按写入顺序淘汰
+        self._recent_keys: "OrderedDict[Tuple[str, str, str, int], None]" = OrderedDict()
+        self._recent_keys_lock = threading.Lock()
 
     async def initialize(self):
         """初始化服务 - 读取用户配置并确定交易所"""
@@ -30,16 +86,9 @@ class KlineDataService:
             return
 
         try:
-            # 从数据库读取用户选择的交易所
-            with SessionLocal() as db:
-                config = db.query(UserExchangeConfig).filter(
-                    UserExchangeConfig.user_id == 1
-                ).first()
-
-                if config:
-                    self.exchange_id = config.selected_exchange
-                else:
-                    self.exchange_id = "hyperliquid"  # 默认值
+            # 从数据库读取用户选择的交易所（同步查询放到线程池执行）
+            selected_exchange = await asyncio.to_thread(self._read_selected_exchange)
+            self.exchange_id = selected_exchange or "hyperliquid"  # 默认值
 
             # 初始化对应的采集器
             self.collector = ExchangeDataSourceFactory.get_collector(self.exchange_id)
@@ -54,6 +103,15 @@ class KlineDataService:
             self.collector = ExchangeDataSourceFactory.get_collector(self.exchange_id)
             self._initialized = True
 
+    @staticmethod
+    def _read_selected_exchange() -> Optional[str]:
+        """读取用户配置的交易所，未配置时返回 None"""
+        with SessionLocal() as db:
+            config = db.query(UserExchangeConfig).filter(
+                UserExchangeConfig.user_id == 1
+            ).first()
+            return config.selected_exchange if config else None
+
     def _ensure_initialized(self):
         """确保服务已初始化"""
         if not self._initialized:
@@ -71,7 +129,7 @@ class KlineDataService:
                 return False
 
             # 插入数据库（自动去重）
-            return await self._insert_kline_data([kline_data])
+            return await self._insert_single(kline_data)
 
         except Exception as e:
             logger.error(f"Failed to collect current kline for {symbol}: {e}")
@@ -107,74 +165,154 @@ class KlineDataService:
 
     async def _insert_kline_data(self, klines_data: List[KlineData]) -> bool:
         """批量插入K线数据到数据库（自动去重）"""
+        # 跳过最近已写入的K线（实时采集会反复提交同一根未收盘K线，入库的始终是第一次写入的行）
+        with self._recent_keys_lock:
+            recent_keys = self._recent_keys
+            klines_data = [
+                kline for kline in klines_data
+                if (kline.exchange, kline.symbol, kline.period, kline.timestamp) not in recent_keys
+            ]
         if not klines_data:
             return True
 
+        # 按唯一索引列顺序排序（market/environment 为常量），提升 B-tree 插入的局部性；与正确性无关
+        klines_data.sort(key=_KLINE_SORT_KEY)
+
         try:
-            with SessionLocal() as db:
-                for kline in klines_data:
-                    # Generate datetime_str from timestamp (UTC)
-                    datetime_str = datetime.utcfromtimestamp(kline.timestamp).strftime('%Y-%m-%d %H:%M:%S')
-
-                    # 使用原生SQL的ON CONFLICT DO NOTHING实现去重
-                    # NOTE: K线数据库只存储 mainnet 数据，testnet 数据实时获取不存储
-                    db.execute(text("""
-                        INSERT INTO crypto_klines (
-                            exchange, symbol, market, timestamp, period, datetime_str,
-                            open_price, high_price, low_price, close_price, volume,
-                            environment, created_at
-                        ) VALUES (
-                            :exchange, :symbol, :market, :timestamp, :period, :datetime_str,
-                            :open_price, :high_price, :low_price, :close_price, :volume,
-                            'mainnet', CURRENT_TIMESTAMP
-                        ) ON CONFLICT (exchange, symbol, market, period, timestamp, environment) DO NOTHING
-                    """), {
-                        'exchange': kline.exchange,
-                        'symbol': kline.symbol,
-                        'market': 'CRYPTO',
-                        'timestamp': kline.timestamp,
-                        'period': kline.period,
-                        'datetime_str': datetime_str,
-                        'open_price': kline.open_price,
-                        'high_price': kline.high_price,
-                        'low_price': kline.low_price,
-                        'close_price': kline.close_price,
-                        'volume': kline.volume
-                    })
-
-                db.commit()
-                logger.debug(f"Inserted {len(klines_data)} klines for {klines_data[0].symbol}")
-                return True
+            rows = [_kline_row(kline) for kline in klines_data]
+
+            # 同步数据库写入放到线程池执行，避免阻塞事件循环
+            await asyncio.to_thread(self._write_kline_rows, rows)
+            self._remember_klines(klines_data)
+
+            logger.debug(f"Inserted {len(klines_data)} klines for {klines_data[0].symbol}")
+            return True
 
         except Exception as e:
             logger.error(f"Failed to insert kline data: {e}")
             return False
 
-    async def get_data_coverage(self, symbols: List[str] = None) -> List[Dict[str, Any]]:
-        """获取数据覆盖情况"""
-        self._ensure_initialized()
+    async def _insert_single(self, kline: KlineData) -> bool:
+        """插入单根K线（实时采集路径），跳过批量路径的过滤、排序和 savepoint"""
+        with self._recent_keys_lock:
+            if (kline.exchange, kline.symbol, kline.period, kline.timestamp) in self._recent_keys:
+                return True
+
+        try:
+            await asyncio.to_thread(self._write_single_row, _kline_row(kline))
+            self._remember_klines((kline,))
+            return True
+
+        except Exception as e:
+            logger.error(f"Failed to insert kline data: {e}")
+            return False
 
+    @staticmethod
+    def _write_single_row(row: Dict[str, Any]):
+        """单行写入直接使用 ON CONFLICT DO NOTHING（同步，运行在线程池中）"""
+        with SessionLocal() as db:
+            db.execute(_KLINE_INSERT_IGNORE_CONFLICTS, [row])
+            db.commit()
+
+    def _remember_klines(self, klines_data: Iterable[KlineData]):
+        """记录已写入的K线键，超出上限时淘汰最早的"""
+        with self._recent_keys_lock:
+            for kline in klines_data:
+                self._recent_keys[(kline.exchange, kline.symbol, kline.period, kline.timestamp)] = None
+            while len(self._recent_keys) > RECENT_KLINE_KEYS_LIMIT:
+                self._recent_keys.popitem(last=False)
+
+    def _write_kline_rows(self, rows: List[Dict[str, Any]]):
+        """在一个事务内写入K线行（同步，运行在线程池中）"""
+        with SessionLocal() as db:
+            if len(rows) >= KLINE_COPY_THRESHOLD:
+                # 大批量回填：COPY 到临时表后一次性 INSERT ... SELECT
+                self._copy_kline_rows(db, rows)
+            else:
+                self._insert_kline_batch(db, rows)
+
+            db.commit()
+
+    def _insert_kline_batch(self, db: Session, rows: List[Dict[str, Any]]):
+        """
+        插入一批K线：先在 savepoint 中直接 INSERT，冲突时再用 ON CONFLICT DO NOTHING 重试
+
+        正常的向前采集很少出现重复，直接 INSERT 省去了每行的冲突检测开销
+        """
+        # 在 to_thread 工作线程中执行，计数器需加锁更新
+        with self._insert_stats_lock:
+            self._insert_batch_count += 1
+        try:
+            with db.begin_nested():
+                db.execute(_KLINE_INSERT, rows)
+            return
+        except IntegrityError:
+            with self._insert_stats_lock:
+                self._insert_fallback_count += 1
+                fallback_count = self._insert_fallback_count
+                batch_count = self._insert_batch_count
+
+        db.execute(_KLINE_INSERT_IGNORE_CONFLICTS, rows)
+        logger.debug(
+            f"Kline insert conflict fallback for {rows[0]['symbol']}: "
+            f"{fallback_count}/{batch_count} batches"
+        )
+
+    def _copy_kline_rows(self, db: Session, rows: List[Dict[str, Any]]):
+        """通过 COPY FROM STDIN 写入临时表，再去重插入 crypto_klines"""
+        columns = ', '.join(KLINE_COPY_COLUMNS)
+
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerows([row[column] for column in KLINE_COPY_COLUMNS] for row in rows)
+        buffer.seek(0)
+
+        # 临时表只复制列类型，不带 id 序列默认值和约束；事务提交时自动删除
+        db.execute(text(f"""
+            CREATE TEMP TABLE _stage_klines ON COMMIT DROP AS
+            SELECT {columns} FROM crypto_klines WITH NO DATA
+        """))
+        cursor = db.connection().connection.cursor()
         try:
-            with SessionLocal() as db:
-                query = """
-                    SELECT * FROM kline_coverage_stats
-                    WHERE exchange = :exchange
-                """
-                params = {'exchange': self.exchange_id}
+            cursor.copy_expert(f"COPY _stage_klines ({columns}) FROM STDIN WITH (FORMAT CSV)", buffer)
+        finally:
+            cursor.close()
 
-                if symbols:
-                    query += " AND symbol = ANY(:symbols)"
-                    params['symbols'] = symbols
+        db.execute(text(f"""
+            INSERT INTO crypto_klines ({columns})
+            SELECT {columns} FROM _stage_klines
+            ON CONFLICT ({', '.join(KLINE_CONFLICT_COLUMNS)}) DO NOTHING
+        """))
 
-                query += " ORDER BY symbol, period"
+    async def get_data_coverage(self, symbols: List[str] = None) -> Sequence[Mapping[str, Any]]:
+        """获取数据覆盖情况"""
+        self._ensure_initialized()
 
-                result = db.execute(text(query), params)
-                return [dict(row._mapping) for row in result]
+        try:
+            return await asyncio.to_thread(self._query_data_coverage, symbols)
 
         except Exception as e:
             logger.error(f"Failed to get data coverage: {e}")
             return []
 
+    def _query_data_coverage(self, symbols: Optional[List[str]]) -> Sequence[Mapping[str, Any]]:
+        """查询 kline_coverage_stats 视图（同步，运行在线程池中）"""
+        with SessionLocal() as db:
+            query = """
+                SELECT * FROM kline_coverage_stats
+                WHERE exchange = :exchange
+            """
+            params = {'exchange': self.exchange_id}
+
+            if symbols:
+                query += " AND symbol = ANY(:symbols)"
+                params['symbols'] = symbols
+
+            query += " ORDER BY symbol, period"
+
+            # RowMapping 是只读 Mapping，调用方用 ** 解包即可，无需逐行复制成 dict
+            return db.execute(text(query), params).mappings().all()
+
     async def detect_missing_ranges(
         self,
         symbol: str,
@@ -186,59 +324,61 @@ class KlineDataService:
         self._ensure_initialized()
 
         try:
-            with SessionLocal() as db:
-                # 获取现有的时间戳
-                result = db.execute(text("""
-                    SELECT timestamp FROM crypto_klines
-                    WHERE exchange = :exchange AND symbol = :symbol
-                    AND period = :period AND timestamp BETWEEN :start_ts AND :end_ts
-                    ORDER BY timestamp
-                """), {
-                    'exchange': self.exchange_id,
-                    'symbol': symbol,
-                    'period': period,
-                    'start_ts': int(start_time.timestamp()),
-                    'end_ts': int(end_time.timestamp())
-                })
-
-                existing_timestamps = {row[0] for row in result}
-
-                # 生成期望的时间戳序列（1分钟间隔）
-                expected_timestamps = []
-                current = start_time
-                while current <= end_time:
-                    expected_timestamps.append(int(current.timestamp()))
-                    current += timedelta(minutes=1)
-
-                # 找出缺失的时间段
-                missing_ranges = []
-                range_start = None
-
-                for ts in expected_timestamps:
-                    if ts not in existing_timestamps:
-                        if range_start is None:
-                            range_start = ts
-                    else:
-                        if range_start is not None:
-                            missing_ranges.append((
-                                datetime.fromtimestamp(range_start),
-                                datetime.fromtimestamp(ts - 60)  # 前一分钟
-                            ))
-                            range_start = None
-
-                # 处理最后一个缺失段
-                if range_start is not None:
-                    missing_ranges.append((
-                        datetime.fromtimestamp(range_start),
-                        end_time
-                    ))
-
-                return missing_ranges
+            start_ts = int(start_time.timestamp())
+            end_ts = int(end_time.timestamp())
+
+            missing_timestamps = await asyncio.to_thread(
+                self._query_missing_timestamps, symbol, period, start_ts, end_ts
+            )
+
+            if not len(missing_timestamps):
+                return []
+
+            # 找出缺失的时间段：相邻缺失点间隔不是 60 秒处即为断点
+            breaks = np.flatnonzero(np.diff(missing_timestamps) != 60)
+            run_starts = missing_timestamps[np.concatenate(([0], breaks + 1))].tolist()
+            run_ends = missing_timestamps[np.concatenate((breaks, [len(missing_timestamps) - 1]))].tolist()
+            # 期望序列的最后一个时间点
+            last_expected = start_ts + (end_ts - start_ts) // 60 * 60
+
+            missing_ranges = []
+            for first, last in zip(run_starts, run_ends):
+                missing_ranges.append((
+                    datetime.fromtimestamp(first),
+                    # 最后一个缺失段延伸到 end_time
+                    end_time if last == last_expected else datetime.fromtimestamp(last)
+                ))
+
+            return missing_ranges
 
         except Exception as e:
             logger.error(f"Failed to detect missing ranges: {e}")
             return []
 
+    def _query_missing_timestamps(self, symbol: str, period: str, start_ts: int, end_ts: int) -> np.ndarray:
+        """查询窗口内缺失的分钟时间戳（升序；同步，运行在线程池中）"""
+        with SessionLocal() as db:
+            # 在数据库内用 generate_series 生成期望的时间戳序列（1分钟间隔），只取回缺失点
+            result = db.execute(text("""
+                WITH expected AS (
+                    SELECT generate_series(:start_ts, :end_ts, 60) AS ts
+                )
+                SELECT expected.ts FROM expected
+                LEFT JOIN crypto_klines k
+                    ON k.exchange = :exchange AND k.symbol = :symbol
+                    AND k.period = :period AND k.timestamp = expected.ts
+                WHERE k.timestamp IS NULL
+                ORDER BY expected.ts
+            """), {
+                'exchange': self.exchange_id,
+                'symbol': symbol,
+                'period': period,
+                'start_ts': start_ts,
+                'end_ts': end_ts
+            })
+
+            return np.fromiter((row[0] for row in result), dtype=np.int64)
+
     def get_supported_symbols(self) -> List[str]:
         """获取当前交易所支持的交易对"""
         self._ensure_initialized()
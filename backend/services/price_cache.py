@@ -2,14 +2,18 @@
 Price caching service to reduce API calls and provide short-term history.
 """
 
+import heapq
 import time
-from typing import Deque, Dict, List, Optional, Tuple
+from typing import Deque, Dict, Iterable, List, Optional, Tuple
 import logging
 from threading import Lock
 from collections import deque
 
 logger = logging.getLogger(__name__)
 
+# Number of lock stripes in PriceCache (power of two so a mask selects the stripe)
+LOCK_STRIPES = 32
+
 
 class PriceCache:
     """In-memory price cache with TTL and rolling history retention."""
@@ -21,14 +25,25 @@ class PriceCache:
         self.history: Dict[Tuple[str, str, str], Deque[Tuple[float, float]]] = {}
         self.ttl_seconds = ttl_seconds
         self.history_seconds = history_seconds
-        self.lock = Lock()
+        # Striped locks: keys on different stripes never contend with each other
+        self._num_stripes = LOCK_STRIPES
+        self._locks = [Lock() for _ in range(self._num_stripes)]
+        # Min-heap of (expiry_time, key) with at most one entry per key, pushed when a key
+        # first appears; refreshed keys are re-pushed by clear_expired() when their entry
+        # comes due, so record() stays stripe-local. Lock order: stripe lock, then heap lock.
+        self._expiry_heap: List[Tuple[float, Tuple[str, str, str]]] = []
+        self._scheduled_keys = set()
+        self._heap_lock = Lock()
+
+    def _lock_for(self, key: Tuple[str, str, str]) -> Lock:
+        return self._locks[hash(key) & (self._num_stripes - 1)]
 
     def get(self, symbol: str, market: str, environment: str = "mainnet") -> Optional[float]:
         """Get cached price if still within TTL."""
         key = (symbol, market, environment)
         current_time = time.time()
 
-        with self.lock:
+        with self._lock_for(key):
             entry = self.cache.get(key)
             if not entry:
                 return None
@@ -48,50 +63,103 @@ class PriceCache:
         key = (symbol, market, environment)
         event_time = timestamp or time.time()
 
-        with self.lock:
-            self.cache[key] = (price, event_time)
+        with self._lock_for(key):
+            self._store(key, price, event_time)
+            if key not in self._scheduled_keys:
+                self._schedule(key, event_time + self.ttl_seconds)
 
-            history_queue = self.history.setdefault(key, deque())
-            history_queue.append((event_time, price))
+        logger.debug("Recorded price update for %s.%s.%s: %s @ %s", symbol, market, environment, price, event_time)
 
-            cutoff = event_time - self.history_seconds
-            while history_queue and history_queue[0][0] < cutoff:
-                history_queue.popleft()
+    def record_many(self, updates: Iterable[Tuple[str, str, float, Optional[float], str]]) -> None:
+        """Record (symbol, market, price, timestamp, environment) updates, locking each stripe once."""
+        now = time.time()
+        by_stripe: Dict[int, List[Tuple[Tuple[str, str, str], float, float]]] = {}
+        mask = self._num_stripes - 1
+        for symbol, market, price, timestamp, environment in updates:
+            key = (symbol, market, environment)
+            by_stripe.setdefault(hash(key) & mask, []).append(
+                (key, price, timestamp or now)
+            )
 
-        logger.debug("Recorded price update for %s.%s.%s: %s @ %s", symbol, market, environment, price, event_time)
+        count = 0
+        for stripe, entries in by_stripe.items():
+            with self._locks[stripe]:
+                for key, price, event_time in entries:
+                    self._store(key, price, event_time)
+                    if key not in self._scheduled_keys:
+                        self._schedule(key, event_time + self.ttl_seconds)
+                count += len(entries)
+
+        logger.debug("Recorded %d price updates", count)
+
+    def _schedule(self, key: Tuple[str, str, str], expiry: float) -> None:
+        """Push key's expiry check; caller holds the key's stripe lock."""
+        with self._heap_lock:
+            heapq.heappush(self._expiry_heap, (expiry, key))
+            self._scheduled_keys.add(key)
+
+    def _store(self, key: Tuple[str, str, str], price: float, event_time: float) -> None:
+        """Write cache entry and history sample; caller holds the key's stripe lock."""
+        self.cache[key] = (price, event_time)
+
+        history_queue = self.history.get(key)
+        if history_queue is None:
+            history_queue = self.history[key] = deque()
+        history_queue.append((event_time, price))
+
+        cutoff = event_time - self.history_seconds
+        while history_queue[0][0] < cutoff:
+            history_queue.popleft()
 
     def clear_expired(self) -> None:
         """Remove expired cache entries and prune history."""
         current_time = time.time()
         cutoff = current_time - self.history_seconds
 
-        with self.lock:
-            expired_keys = [
-                key for key, (_, ts) in self.cache.items() if current_time - ts >= self.ttl_seconds
-            ]
-            for key in expired_keys:
-                self.cache.pop(key, None)
-                self.history.pop(key, None)
-
-            for key, queue in list(self.history.items()):
-                while queue and queue[0][0] < cutoff:
-                    queue.popleft()
-                if not queue:
+        # Only keys whose scheduled expiry has passed are visited, instead of every key
+        with self._heap_lock:
+            due = []
+            while self._expiry_heap and self._expiry_heap[0][0] <= current_time:
+                due.append(heapq.heappop(self._expiry_heap)[1])
+
+        expired_count = 0
+        for key in due:
+            with self._lock_for(key):
+                entry = self.cache.get(key)
+                if entry:
+                    if current_time - entry[1] < self.ttl_seconds:
+                        # Recorded again since it was scheduled; check back at its new expiry
+                        self._schedule(key, entry[1] + self.ttl_seconds)
+                        continue
+                    del self.cache[key]
                     self.history.pop(key, None)
-
-        if expired_keys:
-            logger.debug("Cleared %d expired cache entries", len(expired_keys))
+                    expired_count += 1
+                else:
+                    # Cache entry already purged by get(); retire the history once it ages out
+                    history_queue = self.history.get(key)
+                    if history_queue is not None:
+                        _prune(history_queue, cutoff)
+                        if history_queue:
+                            self._schedule(key, history_queue[-1][0] + self.history_seconds)
+                            continue
+                        del self.history[key]
+
+                with self._heap_lock:
+                    self._scheduled_keys.discard(key)
+
+        if expired_count:
+            logger.debug("Cleared %d expired cache entries", expired_count)
 
     def get_cache_stats(self) -> Dict:
         """Get short-term cache and history stats."""
         current_time = time.time()
 
-        with self.lock:
-            valid_entries = sum(
-                1 for _, ts in self.cache.values() if current_time - ts < self.ttl_seconds
-            )
-            history_entries = sum(len(q) for q in self.history.values())
-            total_entries = len(self.cache)
+        # Diagnostics only: read point-in-time snapshots instead of locking every stripe
+        entries = list(self.cache.values())
+        queues = list(self.history.values())
+        valid_entries = sum(1 for _, ts in entries if current_time - ts < self.ttl_seconds)
+        history_entries = sum(len(q) for q in queues)
+        total_entries = len(entries)
 
         return {
             "total_entries": total_entries,
@@ -104,13 +172,21 @@ class PriceCache:
     def get_history(self, symbol: str, market: str, environment: str = "mainnet") -> List[Tuple[float, float]]:
         """Return rolling history for symbol within retention window."""
         key = (symbol, market, environment)
-        with self.lock:
+        with self._lock_for(key):
             queue = self.history.get(key)
             if not queue:
                 return []
+            # History is pruned lazily when read or written rather than by a periodic sweep
+            _prune(queue, time.time() - self.history_seconds)
             return list(queue)
 
 
+def _prune(history_queue: Deque[Tuple[float, float]], cutoff: float) -> None:
+    """Drop history entries older than cutoff."""
+    while history_queue and history_queue[0][0] < cutoff:
+        history_queue.popleft()
+
+
 # Global price cache instance
 price_cache = PriceCache(ttl_seconds=30, history_seconds=3600)
 
@@ -130,6 +206,11 @@ def record_price_update(symbol: str, market: str, price: float, timestamp: Optio
     price_cache.record(symbol, market, price, timestamp, environment)
 
 
+def record_price_updates(updates: Iterable[Tuple[str, str, float, Optional[float], str]]) -> None:
+    """Record a batch of (symbol, market, price, timestamp, environment) updates."""
+    price_cache.record_many(updates)
+
+
 def get_price_history(symbol: str, market: str = "CRYPTO", environment: str = "mainnet") -> List[Tuple[float, float]]:
     """Return recent price history (timestamp, price)."""
     return price_cache.get_history(symbol, market, environment)
@@ -0,0 +1,36 @@
+"""
+Fast JSON helpers
+
+Uses orjson when it is installed and falls back to the standard library otherwise.
+dumps() always returns str so results can be stored directly in Text columns.
+"""
+import json
+
+try:
+    import orjson
+except ImportError:  # orjson is an optional speedup
+    orjson = None
+
+# orjson.JSONDecodeError subclasses json.JSONDecodeError, so one except clause covers both
+JSONDecodeError = json.JSONDecodeError
+
+
+def loads(value):
+    """Parse JSON from str or bytes"""
+    if orjson is not None:
+        return orjson.loads(value)
+    return json.loads(value)
+
+
+def dumps(value) -> str:
+    """Serialize value to a compact JSON string"""
+    if orjson is not None:
+        return orjson.dumps(value).decode()
+    return json.dumps(value)
+
+
+def dumps_bytes(value) -> bytes:
+    """Serialize value to UTF-8 JSON bytes, e.g. for an HTTP request body"""
+    if orjson is not None:
+        return orjson.dumps(value)
+    return json.dumps(value).encode()